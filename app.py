@@ -4,11 +4,14 @@ ModPlayer - Daily Module Music Discovery
 Main Flask application.
 """
 import logging
+import os
 import sys
 from pathlib import Path
 
+import orjson
 from flask import Flask
-from flask_cors import CORS
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
 
 from config import Config
 from models import db
@@ -16,10 +19,37 @@ from routes.api import api_bp
 from routes.web import web_bp
 
 
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for faster API serialization."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Apply performance pragmas to each new SQLite connection.
+
+    WAL mode lets readers proceed concurrently with rating/selection
+    writes; the cache and mmap settings cut page I/O on the hot tables.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-64000')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
+
 def create_app(config_class=Config):
     """Application factory."""
     app = Flask(__name__)
     app.config.from_object(config_class)
+    app.json = ORJSONProvider(app)
     
     # Ensure required directories exist
     config_class.ensure_directories()
@@ -29,16 +59,28 @@ def create_app(config_class=Config):
     
     # Initialize extensions
     db.init_app(app)
-    CORS(app)  # Enable CORS for API requests
+    if config_class.ENABLE_CORS:
+        # Imported lazily so processes without CORS skip the dependency
+        from flask_cors import CORS
+        CORS(app)  # Enable CORS for API requests
     
     # Register blueprints
     app.register_blueprint(web_bp)
     app.register_blueprint(api_bp)
     
-    # Create database tables
+    # Create database tables. Skipped on warm starts against an existing
+    # SQLite file so worker boots don't pay the schema reflection;
+    # init_db.py (or RUN_CREATE_ALL=1) handles schema changes.
     with app.app_context():
-        db.create_all()
-        app.logger.info('Database tables created')
+        if config_class.is_sqlite():
+            # Register before the first connection so every connection
+            # (including create_all's) gets the pragmas
+            event.listens_for(db.engine, 'connect')(_set_sqlite_pragmas)
+        if (not config_class.is_sqlite()
+                or not Path(config_class.DATABASE_PATH).exists()
+                or os.getenv('RUN_CREATE_ALL') == '1'):
+            db.create_all()
+            app.logger.info('Database tables created')
     
     app.logger.info('ModPlayer application started')
     return app
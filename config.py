@@ -5,7 +5,7 @@ Loads configuration from environment variables with sensible defaults.
 """
 import os
 from pathlib import Path
-from typing import List
+from typing import FrozenSet
 
 
 class Config:
@@ -18,6 +18,7 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
     FLASK_ENV = os.getenv('FLASK_ENV', 'development')
     DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
+    ENABLE_CORS = os.getenv('ENABLE_CORS', 'True').lower() == 'true'
     
     # Database
     DATABASE_PATH = os.getenv('DATABASE_PATH', str(BASE_DIR / 'data' / 'database.db'))
@@ -31,10 +32,11 @@ class Config:
     
     # Module selection
     DAILY_MODULE_COUNT = 5  # Fixed at 5 modules per day
-    PREFERRED_FORMATS: List[str] = os.getenv(
-        'PREFERRED_FORMATS',
-        'mod,xm,s3m,it'
-    ).split(',')
+    # Normalized once at load; every consumer gets O(1) membership checks
+    PREFERRED_FORMATS: FrozenSet[str] = frozenset(
+        fmt.strip().lower()
+        for fmt in os.getenv('PREFERRED_FORMATS', 'mod,xm,s3m,it').split(',')
+    )
     
     # Cache settings
     CACHE_DIR = Path(os.getenv('CACHE_DIR', str(BASE_DIR / 'cache' / 'modules')))
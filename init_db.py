@@ -4,8 +4,13 @@ Database Initialization Script
 Creates database tables and optionally seeds initial data.
 """
 import logging
+import os
 from pathlib import Path
 
+# Force table creation even when the database file already exists;
+# normal app boots skip it (see create_app)
+os.environ.setdefault('RUN_CREATE_ALL', '1')
+
 from app import app, db
 from config import Config
 
@@ -24,6 +29,14 @@ def init_database():
         # Create all tables
         db.create_all()
         logger.info('Database tables created successfully')
+
+        # create_all only covers new tables; make sure existing databases
+        # pick up indexes added after their schema was created
+        db.session.execute(db.text(
+            'CREATE INDEX IF NOT EXISTS ix_sm_selection_position '
+            'ON selection_modules (selection_id, position)'
+        ))
+        db.session.commit()
         
         # Print database info
         if Config.is_sqlite():
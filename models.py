@@ -7,11 +7,16 @@ from datetime import datetime
 from typing import Optional
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey, UniqueConstraint
+from sqlalchemy import ForeignKey, UniqueConstraint, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 db = SQLAlchemy()
 
+# Cached base dicts for Module.to_dict keyed by module ID. Entries carry
+# the module's cached_at as a token so metadata refreshes invalidate them.
+_MODULE_DICT_CACHE: dict = {}
+_MODULE_DICT_CACHE_MAX = 1024
+
 
 class DailySelection(db.Model):
     """Represents a daily module selection."""
@@ -20,14 +25,23 @@ class DailySelection(db.Model):
     
     id: Mapped[int] = mapped_column(primary_key=True)
     date: Mapped[datetime] = mapped_column(db.Date, unique=True, nullable=False, index=True)
-    created_at: Mapped[datetime] = mapped_column(db.DateTime, default=datetime.utcnow)
+    # Client-side default kept alongside server_default: pre-existing
+    # databases were created without a DEFAULT clause, so inserts must
+    # stay self-sufficient there
+    created_at: Mapped[datetime] = mapped_column(db.DateTime, default=datetime.utcnow,
+                                                 server_default=func.now())
     
     # Relationships
     modules = relationship(
         'Module',
         secondary='selection_modules',
         back_populates='daily_selections',
-        lazy='joined'
+        lazy='selectin'
+    )
+    selection_modules = relationship(
+        'SelectionModule',
+        order_by='SelectionModule.position',
+        viewonly=True
     )
     
     def __repr__(self) -> str:
@@ -57,26 +71,40 @@ class Module(db.Model):
         secondary='selection_modules',
         back_populates='modules'
     )
-    ratings = relationship('UserRating', back_populates='module', cascade='all, delete-orphan')
+    ratings = relationship(
+        'UserRating',
+        back_populates='module',
+        cascade='all, delete-orphan',
+        lazy='selectin'
+    )
     
     def __repr__(self) -> str:
         return f'<Module {self.id}: {self.filename}>'
     
     def to_dict(self, include_rating: bool = False) -> dict:
         """Convert module to dictionary representation."""
-        data = {
-            'id': self.id,
-            'filename': self.filename,
-            'title': self.title,
-            'artist': self.artist,
-            'format': self.format,
-            'size': self.size,
-            'download_url': self.download_url,
-            'modarchive_url': self.modarchive_url,
-            'date_added': self.date_added.isoformat() if self.date_added else None,
-            'source_type': self.source_type,
-        }
-        
+        # The stable fields only change when the module row is rewritten,
+        # so reuse a cached copy instead of rebuilding the dict each call
+        cached = _MODULE_DICT_CACHE.get(self.id)
+        if cached is not None and cached[0] == self.cached_at:
+            data = dict(cached[1])
+        else:
+            data = {
+                'id': self.id,
+                'filename': self.filename,
+                'title': self.title,
+                'artist': self.artist,
+                'format': self.format,
+                'size': self.size,
+                'download_url': self.download_url,
+                'modarchive_url': self.modarchive_url,
+                'date_added': self.date_added.isoformat() if self.date_added else None,
+                'source_type': self.source_type,
+            }
+            if len(_MODULE_DICT_CACHE) >= _MODULE_DICT_CACHE_MAX:
+                _MODULE_DICT_CACHE.clear()
+            _MODULE_DICT_CACHE[self.id] = (self.cached_at, dict(data))
+
         if include_rating and self.ratings:
             rating = self.ratings[0]  # Should only be one rating per user
             data['user_rating'] = {
@@ -96,14 +124,20 @@ class SelectionModule(db.Model):
     __tablename__ = 'selection_modules'
     
     id: Mapped[int] = mapped_column(primary_key=True)
-    selection_id: Mapped[int] = mapped_column(ForeignKey('daily_selections.id'), nullable=False, index=True)
+    selection_id: Mapped[int] = mapped_column(ForeignKey('daily_selections.id'), nullable=False)
     module_id: Mapped[int] = mapped_column(ForeignKey('modules.id'), nullable=False, index=True)
     position: Mapped[int] = mapped_column(db.Integer, nullable=False)  # Order in list (1-5)
-    
+
     __table_args__ = (
         UniqueConstraint('selection_id', 'module_id', name='uq_selection_module'),
+        # Covers the hot "modules for a selection ordered by position"
+        # query without a sort; also subsumes the old selection_id index
+        db.Index('ix_sm_selection_position', 'selection_id', 'position'),
     )
-    
+
+    # Relationships
+    module = relationship('Module', viewonly=True)
+
     def __repr__(self) -> str:
         return f'<SelectionModule selection={self.selection_id} module={self.module_id} pos={self.position}>'
 
@@ -117,8 +151,12 @@ class UserRating(db.Model):
     module_id: Mapped[int] = mapped_column(ForeignKey('modules.id'), nullable=False, index=True, unique=True)
     rating: Mapped[int] = mapped_column(db.Integer, nullable=False)  # 1-5 stars
     comment: Mapped[Optional[str]] = mapped_column(db.Text)
-    rated_at: Mapped[datetime] = mapped_column(db.DateTime, default=datetime.utcnow)
-    updated_at: Mapped[datetime] = mapped_column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Client-side defaults kept alongside server_default for databases
+    # created before the DEFAULT clauses existed (see DailySelection)
+    rated_at: Mapped[datetime] = mapped_column(db.DateTime, default=datetime.utcnow,
+                                               server_default=func.now())
+    updated_at: Mapped[datetime] = mapped_column(db.DateTime, default=datetime.utcnow,
+                                                 server_default=func.now(), onupdate=func.now())
     
     # Relationships
     module = relationship('Module', back_populates='ratings')
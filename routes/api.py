@@ -6,21 +6,28 @@ RESTful API endpoints for the ModPlayer application.
 import logging
 from datetime import date, datetime
 
-from flask import Blueprint, jsonify, request, send_file
-from io import BytesIO
+from cachetools import TTLCache
+from flask import Blueprint, Response, jsonify, request, send_file
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
+from config import Config
 from models import Module, UserRating, db
-from services.curator import curator_service
-from services.player import player_service
 
 logger = logging.getLogger(__name__)
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
+# Pre-serialized /api/daily payloads keyed by date. The selection only
+# changes at midnight; new ratings invalidate the cache explicitly.
+_daily_cache = TTLCache(maxsize=8, ttl=300)
+
 
 @api_bp.route('/daily', methods=['GET'])
 def get_daily():
     """Get today's module selection."""
+    from services.curator import curator_service
+
     try:
         # Allow querying specific date via query param (for testing/history)
         date_str = request.args.get('date')
@@ -28,13 +35,20 @@ def get_daily():
             selection_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         else:
             selection_date = date.today()
-        
+
+        cache_key = selection_date.isoformat()
+        cached = _daily_cache.get(cache_key)
+        if cached is not None:
+            return Response(cached, mimetype='application/json')
+
         modules = curator_service.get_daily_selection(selection_date)
-        
-        return jsonify({
+
+        response = jsonify({
             'date': selection_date.isoformat(),
             'modules': [m.to_dict(include_rating=True) for m in modules]
         })
+        _daily_cache[cache_key] = response.get_data()
+        return response
     except Exception as e:
         logger.error(f'Error getting daily selection: {e}')
         return jsonify({
@@ -62,25 +76,28 @@ def get_module(module_id: int):
 @api_bp.route('/module/<int:module_id>/download', methods=['GET'])
 def download_module(module_id: int):
     """Download a module file."""
+    from services.player import player_service
+
     try:
         module = Module.query.get_or_404(module_id)
-        
-        # Get module file (from cache or download)
-        file_data = player_service.get_module_file(module)
-        
-        if file_data is None:
+
+        # Ensure the file is cached locally (downloads if needed)
+        file_path = player_service.get_module_path(module)
+
+        if file_path is None:
             return jsonify({
                 'error': True,
                 'message': 'Failed to download module',
                 'code': 'DOWNLOAD_ERROR'
             }), 500
-        
-        # Return file
+
+        # Stream from disk; conditional=True enables 304/Range responses
         return send_file(
-            BytesIO(file_data),
+            file_path,
             mimetype='application/octet-stream',
             as_attachment=False,
-            download_name=module.filename
+            download_name=module.filename,
+            conditional=True
         )
     except Exception as e:
         logger.error(f'Error downloading module {module_id}: {e}')
@@ -132,25 +149,47 @@ def rate_module():
                 'code': 'MODULE_NOT_FOUND'
             }), 404
         
-        # Check if rating already exists
-        user_rating = UserRating.query.filter_by(module_id=module_id).first()
-        
-        if user_rating:
-            # Update existing rating
-            user_rating.rating = rating
-            user_rating.comment = comment
-            user_rating.updated_at = datetime.utcnow()
-        else:
-            # Create new rating
-            user_rating = UserRating(
+        if Config.is_sqlite():
+            # Insert or update in a single round trip; the unique
+            # constraint on module_id resolves the conflict in-engine
+            stmt = sqlite_insert(UserRating).values(
                 module_id=module_id,
                 rating=rating,
                 comment=comment
             )
-            db.session.add(user_rating)
-        
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['module_id'],
+                set_={
+                    'rating': stmt.excluded.rating,
+                    'comment': stmt.excluded.comment,
+                    'updated_at': func.now(),
+                }
+            ).returning(UserRating)
+            user_rating = db.session.execute(stmt).scalar_one()
+        else:
+            # Check if rating already exists
+            user_rating = UserRating.query.filter_by(module_id=module_id).first()
+
+            if user_rating:
+                # Update existing rating; updated_at refreshes via onupdate
+                user_rating.rating = rating
+                user_rating.comment = comment
+            else:
+                # Create new rating
+                user_rating = UserRating(
+                    module_id=module_id,
+                    rating=rating,
+                    comment=comment
+                )
+                db.session.add(user_rating)
+
         db.session.commit()
-        
+
+        # Ratings are embedded in the daily and history payloads
+        _daily_cache.clear()
+        from services.curator import curator_service
+        curator_service.invalidate_history_cache()
+
         return jsonify({
             'success': True,
             'rating': user_rating.to_dict()
@@ -169,6 +208,8 @@ def rate_module():
 @api_bp.route('/history', methods=['GET'])
 def get_history():
     """Get past selections and ratings."""
+    from services.curator import curator_service
+
     try:
         limit = int(request.args.get('limit', 30))
         offset = int(request.args.get('offset', 0))
@@ -199,6 +240,8 @@ def get_history():
 @api_bp.route('/cache/stats', methods=['GET'])
 def get_cache_stats():
     """Get cache statistics."""
+    from services.player import player_service
+
     try:
         stats = player_service.get_cache_stats()
         return jsonify(stats)
@@ -214,6 +257,8 @@ def get_cache_stats():
 @api_bp.route('/cache/clear', methods=['POST'])
 def clear_cache():
     """Clear old cached modules."""
+    from services.player import player_service
+
     try:
         max_age_days = request.args.get('max_age_days', type=int)
         deleted_count = player_service.clear_old_cache(max_age_days)
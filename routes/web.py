@@ -4,12 +4,20 @@ Web Routes
 HTML page routes for the ModPlayer application.
 """
 import logging
+from datetime import datetime
+
 from flask import Blueprint, render_template
+from sqlalchemy import text
+
+from models import db
 
 logger = logging.getLogger(__name__)
 
 web_bp = Blueprint('web', __name__)
 
+# Compiled once at import; /health is polled frequently
+_PING = text('SELECT 1')
+
 
 @web_bp.route('/')
 def index():
@@ -26,12 +34,9 @@ def history():
 @web_bp.route('/health')
 def health():
     """Health check endpoint."""
-    from models import db
-    from datetime import datetime
-    
     try:
         # Test database connection
-        db.session.execute(db.text('SELECT 1'))
+        db.session.execute(_PING)
         db_status = 'connected'
     except Exception as e:
         logger.error(f'Health check database error: {e}')
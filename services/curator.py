@@ -5,21 +5,41 @@ Handles generation of daily module selections.
 """
 import logging
 import random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 from typing import List, Optional
 
-from models import DailySelection, Module, SelectionModule, db
+from cachetools import TTLCache
+from sqlalchemy import func, insert, update
+from sqlalchemy.orm import load_only, noload, selectinload
+
+from models import DailySelection, Module, SelectionModule, UserRating, db
 from config import Config
 from services.modarchive import modarchive_service
 
 logger = logging.getLogger(__name__)
 
+# Number of modules in a daily selection
+SELECTION_SIZE = 5
+
 
 class CuratorService:
     """Service for curating daily module selections."""
     
     def __init__(self):
         self.preferred_formats = Config.PREFERRED_FORMATS
+        # History pages only change when a selection or rating is written;
+        # the short TTL is just a safety net on top of explicit invalidation
+        self._history_cache = TTLCache(maxsize=64, ttl=60)
+        # IDs of existing modules seen during generation, flushed as a
+        # single cached_at UPDATE at the end of _generate_selection
+        self._touched_ids: set = set()
+        # Rated module IDs, loaded once per generation run
+        self._listened_ids: Optional[set] = None
+
+    def invalidate_history_cache(self):
+        """Drop cached history pages after a selection or rating write."""
+        self._history_cache.clear()
     
     def get_daily_selection(self, selection_date: Optional[date] = None) -> List[Module]:
         """
@@ -34,17 +54,22 @@ class CuratorService:
         if selection_date is None:
             selection_date = date.today()
         
-        # Check if selection already exists
-        selection = DailySelection.query.filter_by(date=selection_date).first()
-        
+        # Check if selection already exists. Only the key columns are
+        # needed here; the modules come from an explicit ordered query
+        selection = (
+            DailySelection.query
+            .options(
+                load_only(DailySelection.id, DailySelection.date),
+                noload(DailySelection.modules),
+            )
+            .filter_by(date=selection_date)
+            .one_or_none()
+        )
+
         if selection:
             logger.info(f'Found existing selection for {selection_date}')
-            # Return modules sorted by position
-            modules = sorted(
-                selection.modules,
-                key=lambda m: self._get_module_position(selection, m)
-            )
-            return modules
+            # Return modules ordered by position in a single query
+            return self._get_selection_modules(selection)
         
         # Generate new selection
         logger.info(f'Generating new selection for {selection_date}')
@@ -55,229 +80,332 @@ class CuratorService:
         
         return modules
     
-    def _get_module_position(self, selection: DailySelection, module: Module) -> int:
-        """Get the position of a module in a selection."""
-        sm = SelectionModule.query.filter_by(
-            selection_id=selection.id,
-            module_id=module.id
-        ).first()
-        return sm.position if sm else 999
+    def _get_selection_modules(self, selection: DailySelection) -> List[Module]:
+        """Get the modules for a selection, ordered by position."""
+        return (
+            db.session.query(Module)
+            .join(SelectionModule, SelectionModule.module_id == Module.id)
+            .filter(SelectionModule.selection_id == selection.id)
+            .order_by(SelectionModule.position)
+            .all()
+        )
     
     def _generate_selection(self, selection_date: date) -> List[Module]:
         """
         Generate a new module selection based on criteria.
 
-        Selects exactly 5 modules:
+        Pulls one module per source in priority order until the selection
+        is full:
         1. Featured module (first unlistened from featured chart)
         2. Recent upload (random from recent uploads)
         3. Top rated (random unlistened from random page 1-50)
         4. Top favourite (random unlistened from random page 1-20)
         5. Random module
 
+        If a source comes up empty, the list-backed sources (recent,
+        random) top the selection up so a single dry source doesn't
+        shrink the day's selection.
+
         Returns:
             List of Module objects
         """
-        selected_modules = []
-        selected_ids = set()
-
-        # 1. Get featured module (first unlistened)
-        featured_module = self._fetch_featured_unlistened()
-        if featured_module:
-            selected_modules.append(featured_module)
-            selected_ids.add(featured_module.id)
-            logger.info(f'Selected featured module: {featured_module.filename}')
-        else:
-            logger.warning('No unlistened featured module found')
-
-        # 2. Get one recent upload
-        recent_modules = self._fetch_and_filter_recent()
-        recent_modules = [m for m in recent_modules if m.id not in selected_ids]
-        if recent_modules:
-            recent_module = random.choice(recent_modules)
-            selected_modules.append(recent_module)
-            selected_ids.add(recent_module.id)
-            logger.info(f'Selected recent module: {recent_module.filename}')
-        else:
-            logger.warning('No recent modules found with preferred formats')
-
-        # 3. Get one highly-rated module (from random page, unlistened)
-        rated_module = self._fetch_rated_unlistened(selected_ids)
-        if rated_module:
-            selected_modules.append(rated_module)
-            selected_ids.add(rated_module.id)
-            logger.info(f'Selected highly-rated module: {rated_module.filename}')
-        else:
-            logger.warning('No unlistened highly-rated modules found')
-
-        # 4. Get one top favourite (from random page, unlistened)
-        favourite_module = self._fetch_favourite_unlistened(selected_ids)
-        if favourite_module:
-            selected_modules.append(favourite_module)
-            selected_ids.add(favourite_module.id)
-            logger.info(f'Selected top favourite module: {favourite_module.filename}')
-        else:
-            logger.warning('No unlistened top favourite modules found')
-
-        # 5. Get one random module
-        random_modules = self._fetch_and_filter_random(10)  # Get extras
-        random_modules = [m for m in random_modules if m.id not in selected_ids]
-
-        if random_modules:
-            random_module = random.choice(random_modules)
-            selected_modules.append(random_module)
-            selected_ids.add(random_module.id)
-            logger.info(f'Selected random module: {random_module.filename}')
-        else:
-            logger.warning('No random modules found')
-
-        # 6. Randomize final order
-        random.shuffle(selected_modules)
-
-        logger.info(f'Generated selection with {len(selected_modules)} modules')
-        return selected_modules
+        # Load all rated module IDs once so _is_listened resolves via set
+        # membership instead of one query per candidate
+        self._listened_ids = {
+            module_id
+            for (module_id,) in db.session.query(UserRating.module_id).all()
+        }
+        try:
+            selected_modules = []
+            selected_ids = set()
+
+            # Fetch the independent ModArchive pages concurrently. The workers
+            # do network I/O only; all database work stays on this thread so
+            # the SQLAlchemy session is never shared.
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                featured_future = executor.submit(modarchive_service.fetch_featured)
+                recent_future = executor.submit(modarchive_service.fetch_recent_uploads, limit=30)
+                rated_future = executor.submit(modarchive_service.fetch_top_rated, min_rating=10, max_page=50)
+                favourite_future = executor.submit(modarchive_service.fetch_top_favourites, max_page=20)
+                random_future = executor.submit(modarchive_service.fetch_random_modules, count=30)
+
+                featured_data = featured_future.result()
+                recent_data = recent_future.result()
+                rated_data = rated_future.result()
+                favourite_data = favourite_future.result()
+                random_data = random_future.result()
+
+            # Lazy source generators: each one only does its candidate
+            # processing (DB lookups, creates) when the driver pulls it,
+            # so a full selection skips the work for later sources.
+            def featured_source():
+                module = self._fetch_featured_unlistened(featured_data)
+                if module:
+                    yield module
+
+            def recent_source():
+                modules = self._fetch_and_filter_recent(recent_data)
+                random.shuffle(modules)
+                yield from modules
+
+            def rated_source():
+                module = self._fetch_rated_unlistened(selected_ids, rated_data)
+                if module:
+                    yield module
+
+            def favourite_source():
+                module = self._fetch_favourite_unlistened(selected_ids, favourite_data)
+                if module:
+                    yield module
+
+            def random_source():
+                modules = self._fetch_and_filter_random(10, random_data)
+                random.shuffle(modules)
+                yield from modules
+
+            sources = [
+                ('featured', featured_source()),
+                ('recent', recent_source()),
+                ('rated', rated_source()),
+                ('favourite', favourite_source()),
+                ('random', random_source()),
+            ]
+
+            # First pass: one module per source, in priority order
+            open_sources = []
+            for name, source in sources:
+                if len(selected_modules) >= SELECTION_SIZE:
+                    break
+                module = next((m for m in source if m.id not in selected_ids), None)
+                if module:
+                    selected_modules.append(module)
+                    selected_ids.add(module.id)
+                    logger.info(f'Selected {name} module: {module.filename}')
+                    open_sources.append(source)
+                else:
+                    logger.warning(f'No eligible {name} modules found')
+
+            # Top up from list-backed sources if any source came up dry
+            for source in open_sources:
+                if len(selected_modules) >= SELECTION_SIZE:
+                    break
+                for module in source:
+                    if module.id in selected_ids:
+                        continue
+                    selected_modules.append(module)
+                    selected_ids.add(module.id)
+                    logger.info(f'Topped up selection with module: {module.filename}')
+                    if len(selected_modules) >= SELECTION_SIZE:
+                        break
+
+            # Refresh cached_at for all re-used modules in a single UPDATE
+            # instead of dirtying each ORM instance individually
+            if self._touched_ids:
+                db.session.execute(
+                    update(Module)
+                    .where(Module.id.in_(self._touched_ids))
+                    .values(cached_at=datetime.utcnow())
+                )
+                self._touched_ids.clear()
+
+            # 6. Randomize final order
+            random.shuffle(selected_modules)
+
+            logger.info(f'Generated selection with {len(selected_modules)} modules')
+            return selected_modules
+        finally:
+            self._listened_ids = None
     
+    @staticmethod
+    def _reservoir_choice(candidates):
+        """
+        Pick a uniformly random element from an iterable in one pass.
+
+        Avoids materializing an intermediate filtered list just to call
+        random.choice on it.
+        """
+        chosen = None
+        seen = 0
+        for candidate in candidates:
+            seen += 1
+            if random.randrange(seen) == 0:
+                chosen = candidate
+        return chosen
+
     def _is_listened(self, module_id: int) -> bool:
         """Check if a module has been listened to (has a rating)."""
-        from models import UserRating
-        return UserRating.query.filter_by(module_id=module_id).first() is not None
+        if self._listened_ids is not None:
+            return module_id in self._listened_ids
+        # Existence probe only: EXISTS avoids hydrating a UserRating object
+        return db.session.query(
+            UserRating.query.filter_by(module_id=module_id).exists()
+        ).scalar()
 
-    def _fetch_featured_unlistened(self) -> Optional[Module]:
+    def _fetch_featured_unlistened(self,
+                                   featured_data: Optional[List[dict]] = None) -> Optional[Module]:
         """Fetch the first unlistened featured module."""
         try:
-            featured_data = modarchive_service.fetch_featured()
+            if featured_data is None:
+                featured_data = modarchive_service.fetch_featured()
 
-            # Go through featured modules in order, find first unlistened
+            # Go through featured modules in order, find first unlistened.
+            # The fetcher already filtered for preferred formats.
             for data in featured_data:
                 if not self._is_listened(data['id']):
-                    # Check if it matches preferred format
-                    if data.get('format', '').lower() in [fmt.lower() for fmt in self.preferred_formats]:
-                        module = self._get_or_create_module(data)
-                        if module:
-                            return module
+                    modules = self._bulk_get_or_create([data])
+                    if modules:
+                        return modules[0]
 
             return None
         except Exception as e:
             logger.error(f'Error fetching featured module: {e}')
             return None
 
-    def _fetch_rated_unlistened(self, excluded_ids: set) -> Optional[Module]:
+    def _fetch_rated_unlistened(self, excluded_ids: set,
+                                rated_data: Optional[List[dict]] = None) -> Optional[Module]:
         """Fetch an unlistened highly-rated module from a random page."""
         try:
-            # Fetch from random page (1-50)
-            rated_data = modarchive_service.fetch_top_rated(min_rating=10, max_page=50)
-            filtered_data = modarchive_service.filter_by_format(rated_data, self.preferred_formats)
+            if rated_data is None:
+                # Fetch from random page (1-50)
+                rated_data = modarchive_service.fetch_top_rated(min_rating=10, max_page=50)
 
-            # Filter out already selected and listened modules
-            unlistened = [
-                data for data in filtered_data
+            # Pick uniformly from the eligible candidates in one pass,
+            # without building the intermediate list; the fetcher already
+            # filtered for preferred formats
+            selected_data = self._reservoir_choice(
+                data for data in rated_data
                 if data['id'] not in excluded_ids and not self._is_listened(data['id'])
-            ]
+            )
 
-            if unlistened:
-                # Pick a random one from the page
-                selected_data = random.choice(unlistened)
-                return self._get_or_create_module(selected_data)
+            if selected_data:
+                modules = self._bulk_get_or_create([selected_data])
+                return modules[0] if modules else None
 
             return None
         except Exception as e:
             logger.error(f'Error fetching rated unlistened module: {e}')
             return None
 
-    def _fetch_favourite_unlistened(self, excluded_ids: set) -> Optional[Module]:
+    def _fetch_favourite_unlistened(self, excluded_ids: set,
+                                    favourite_data: Optional[List[dict]] = None) -> Optional[Module]:
         """Fetch an unlistened top favourite module from a random page."""
         try:
-            # Fetch from random page (1-20)
-            favourite_data = modarchive_service.fetch_top_favourites(max_page=20)
-            filtered_data = modarchive_service.filter_by_format(favourite_data, self.preferred_formats)
+            if favourite_data is None:
+                # Fetch from random page (1-20)
+                favourite_data = modarchive_service.fetch_top_favourites(max_page=20)
 
-            # Filter out already selected and listened modules
-            unlistened = [
-                data for data in filtered_data
+            # Pick uniformly from the eligible candidates in one pass,
+            # without building the intermediate list; the fetcher already
+            # filtered for preferred formats
+            selected_data = self._reservoir_choice(
+                data for data in favourite_data
                 if data['id'] not in excluded_ids and not self._is_listened(data['id'])
-            ]
+            )
 
-            if unlistened:
-                # Pick a random one from the page
-                selected_data = random.choice(unlistened)
-                return self._get_or_create_module(selected_data)
+            if selected_data:
+                modules = self._bulk_get_or_create([selected_data])
+                return modules[0] if modules else None
 
             return None
         except Exception as e:
             logger.error(f'Error fetching favourite unlistened module: {e}')
             return None
 
-    def _fetch_and_filter_recent(self) -> List[Module]:
+    def _fetch_and_filter_recent(self, recent_data: Optional[List[dict]] = None) -> List[Module]:
         """Fetch recent uploads and filter by preferred formats."""
         try:
-            recent_data = modarchive_service.fetch_recent_uploads(limit=30)
-            filtered_data = modarchive_service.filter_by_format(recent_data, self.preferred_formats)
-            
-            modules = []
-            for data in filtered_data:
-                module = self._get_or_create_module(data)
-                if module:
-                    modules.append(module)
-            
-            return modules
+            if recent_data is None:
+                recent_data = modarchive_service.fetch_recent_uploads(limit=30)
+            # The fetcher already filtered for preferred formats
+            return self._bulk_get_or_create(recent_data)
         except Exception as e:
             logger.error(f'Error fetching recent modules: {e}')
             return []
     
-    def _fetch_and_filter_random(self, count: int) -> List[Module]:
+    def _fetch_and_filter_random(self, count: int,
+                                 random_data: Optional[List[dict]] = None) -> List[Module]:
         """Fetch random modules and filter by preferred formats."""
         try:
-            # Fetch more than needed since some might not match preferred formats
-            fetch_count = count * 3
-            random_data = modarchive_service.fetch_random_modules(count=fetch_count)
-            filtered_data = modarchive_service.filter_by_format(random_data, self.preferred_formats)
-            
-            modules = []
-            for data in filtered_data:
-                module = self._get_or_create_module(data)
-                if module:
-                    modules.append(module)
-            
-            return modules
+            if random_data is None:
+                # Fetch more than needed since some might not match preferred formats
+                random_data = modarchive_service.fetch_random_modules(count=count * 3)
+            # The fetcher already filtered for preferred formats
+            modules = self._bulk_get_or_create(random_data)
+            if modules:
+                return modules
+
+            # Fall back to already-cached unlistened modules so a
+            # ModArchive outage doesn't leave the random slot empty
+            return (
+                Module.query
+                .filter(Module.format.in_(self.preferred_formats))
+                .filter(~Module.ratings.any())
+                .order_by(func.random())
+                .limit(count)
+                .all()
+            )
         except Exception as e:
             logger.error(f'Error fetching random modules: {e}')
             return []
     
-    def _get_or_create_module(self, data: dict) -> Optional[Module]:
+    def _bulk_get_or_create(self, data_list: List[dict]) -> List[Module]:
         """
-        Get existing module from database or create new one.
-        
+        Get or create modules for a whole batch of candidate data.
+
+        Looks up all candidate IDs in a single IN query and bulk-inserts
+        the missing ones, instead of one SELECT per candidate.
+
         Args:
-            data: Module data dictionary from ModArchive service
-            
+            data_list: Module data dictionaries from ModArchive service
+
         Returns:
-            Module object or None if creation failed
+            List of Module objects in the same order as the input
         """
+        if not data_list:
+            return []
+
         try:
-            module = Module.query.get(data['id'])
-            
-            if module:
-                # Update metadata if needed
-                module.cached_at = datetime.utcnow()
-            else:
-                # Create new module
-                module = Module(
-                    id=data['id'],
-                    filename=data['filename'],
-                    title=data.get('title'),
-                    artist=data.get('artist'),
-                    format=data.get('format'),
-                    download_url=data.get('download_url'),
-                    modarchive_url=data.get('modarchive_url'),
-                    source_type=data.get('source_type'),
-                    cached_at=datetime.utcnow()
-                )
-                db.session.add(module)
-            
-            return module
+            ids = [data['id'] for data in data_list]
+            existing = {
+                m.id: m
+                for m in Module.query.filter(Module.id.in_(ids)).all()
+            }
+
+            now = datetime.utcnow()
+            self._touched_ids.update(existing.keys())
+
+            missing = [data for data in data_list if data['id'] not in existing]
+            if missing:
+                rows = [
+                    {
+                        'id': data['id'],
+                        'filename': data['filename'],
+                        'title': data.get('title'),
+                        'artist': data.get('artist'),
+                        'format': data.get('format'),
+                        'download_url': data.get('download_url'),
+                        'modarchive_url': data.get('modarchive_url'),
+                        'source_type': data.get('source_type'),
+                        'cached_at': now,
+                    }
+                    for data in missing
+                ]
+                stmt = insert(Module)
+                if Config.is_sqlite():
+                    stmt = stmt.prefix_with('OR IGNORE')
+                db.session.execute(stmt, rows)
+
+                created = Module.query.filter(
+                    Module.id.in_([data['id'] for data in missing])
+                ).all()
+                existing.update({m.id: m for m in created})
+
+            # Preserve the input order
+            return [existing[data['id']] for data in data_list if data['id'] in existing]
         except Exception as e:
-            logger.error(f'Error creating module from data {data}: {e}')
-            return None
-    
+            logger.error(f'Error bulk-creating modules: {e}')
+            return []
+
     def _save_selection(self, selection_date: date, modules: List[Module]) -> bool:
         """
         Save a daily selection to the database.
@@ -290,24 +418,20 @@ class CuratorService:
             True if successful, False otherwise
         """
         try:
-            # Create daily selection
-            selection = DailySelection(
-                date=selection_date,
-                created_at=datetime.utcnow()
-            )
+            # Create daily selection; created_at is filled by the database
+            selection = DailySelection(date=selection_date)
             db.session.add(selection)
             db.session.flush()  # Get the ID
-            
-            # Link modules to selection with positions
-            for position, module in enumerate(modules, start=1):
-                selection_module = SelectionModule(
-                    selection_id=selection.id,
-                    module_id=module.id,
-                    position=position
-                )
-                db.session.add(selection_module)
-            
+
+            # Link modules to selection with positions in one INSERT
+            rows = [
+                {'selection_id': selection.id, 'module_id': module.id, 'position': position}
+                for position, module in enumerate(modules, start=1)
+            ]
+            db.session.execute(insert(SelectionModule), rows)
+
             db.session.commit()
+            self.invalidate_history_cache()
             logger.info(f'Saved selection for {selection_date} with {len(modules)} modules')
             return True
             
@@ -327,27 +451,37 @@ class CuratorService:
         Returns:
             List of selection dictionaries with modules and ratings
         """
+        cache_key = (limit, offset)
+        cached = self._history_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         try:
+            # Eager-load the join rows (position-ordered) and their modules
+            # in one batch instead of a query per selection
             selections = (
                 DailySelection.query
+                .options(
+                    noload(DailySelection.modules),
+                    selectinload(DailySelection.selection_modules)
+                    .joinedload(SelectionModule.module),
+                )
                 .order_by(DailySelection.date.desc())
                 .limit(limit)
                 .offset(offset)
                 .all()
             )
-            
+
             history = []
             for selection in selections:
-                modules = sorted(
-                    selection.modules,
-                    key=lambda m: self._get_module_position(selection, m)
-                )
-                
+                modules = [sm.module for sm in selection.selection_modules]
+
                 history.append({
                     'date': selection.date.isoformat(),
                     'modules': [m.to_dict(include_rating=True) for m in modules]
                 })
-            
+
+            self._history_cache[cache_key] = history
             return history
         except Exception as e:
             logger.error(f'Error fetching history: {e}')
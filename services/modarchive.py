@@ -6,17 +6,24 @@ Handles all communication with The Mod Archive API.
 import logging
 import random
 import re
+import threading
 import time
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, FrozenSet, List, Optional
 from urllib.parse import urljoin
 
-import requests
+import requests_cache
 from bs4 import BeautifulSoup
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
 
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+# Compiled once at import; matching runs once per parsed entry
+_FMT_RE = re.compile(r'\.([a-z0-9]{2,4})$')
+
 
 class ModArchiveService:
     """Service for interacting with The Mod Archive."""
@@ -26,35 +33,187 @@ class ModArchiveService:
         self.api_url = Config.MODARCHIVE_API_URL
         self.timeout = Config.REQUEST_TIMEOUT
         self.delay = Config.REQUEST_DELAY
-        self.session = requests.Session()
+        self.preferred_formats = Config.PREFERRED_FORMATS
+        # Cache responses at the HTTP level: the chart/recent pages change
+        # at most daily, so warm curator runs skip the network entirely.
+        # 404s are cached too so dead pages aren't re-fetched. view_random
+        # must never be cached or every "random" pick would repeat.
+        cache_path = Config.CACHE_DIR.parent / 'modarchive_cache'
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.session = requests_cache.CachedSession(
+            str(cache_path),
+            backend='sqlite',
+            expire_after=3600,
+            allowable_codes=(200, 404),
+            stale_if_error=True,
+            urls_expire_after={'*view_random*': requests_cache.DO_NOT_CACHE},
+        )
         self.session.headers.update({
-            'User-Agent': 'ModPlayer/1.0 (Personal mod music player)'
+            'User-Agent': 'ModPlayer/1.0 (Personal mod music player)',
+            # Compressed HTML is roughly an order of magnitude smaller on
+            # the wire; br needs the brotli package installed
+            'Accept-Encoding': 'gzip, deflate, br',
         })
+        # Size the connection pool for the concurrent fetchers so worker
+        # threads reuse keep-alive connections instead of opening new ones
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Shared schedule for the minimum interval between live requests,
+        # so concurrent fetches still respect one global limit
+        self._rate_lock = threading.Lock()
+        self._next_request_at = 0.0
+        # Parsed-page memo: repeated hits on the same chart page within a
+        # few minutes (e.g. a retried generation) skip the HTML re-parse,
+        # not just the network round trip
+        self._page_cache = TTLCache(maxsize=64, ttl=300)
+        self._page_cache_lock = threading.Lock()
+        # Negative cache: URLs that recently parsed to zero modules
+        # (exhausted charts, outage pages) aren't re-fetched for a while
+        self._empty_url_cache: dict = {}
+        # Recently parsed trees keyed by URL, so re-entrant page walks
+        # (the featured loop, retried generations) skip the re-parse when
+        # the HTTP cache serves identical bytes
+        self._soup_cache = TTLCache(maxsize=16, ttl=300)
+
+    _EMPTY_URL_TTL = 600  # seconds before an empty page is retried
+
+    def _is_known_empty(self, url: str) -> bool:
+        """Check whether a URL recently returned an empty page."""
+        return self._empty_url_cache.get(url, 0.0) > time.monotonic()
+
+    def _mark_empty(self, url: str):
+        """Record that a URL parsed to zero modules."""
+        self._empty_url_cache[url] = time.monotonic() + self._EMPTY_URL_TTL
+
+    def _page_cache_get(self, key) -> Optional[List[Dict]]:
+        """Return a copy of a memoized page result, or None on miss."""
+        with self._page_cache_lock:
+            cached = self._page_cache.get(key)
+        return list(cached) if cached is not None else None
+
+    def _page_cache_set(self, key, modules: List[Dict]):
+        """Memoize a successfully parsed page result."""
+        with self._page_cache_lock:
+            self._page_cache[key] = list(modules)
+
+    def cache_clear(self):
+        """Drop all memoized page results and parsed trees."""
+        with self._page_cache_lock:
+            self._page_cache.clear()
+            self._soup_cache.clear()
+
+    def _soup_for(self, url: str, content: bytes) -> BeautifulSoup:
+        """Parse a page, reusing a recent parse of identical content."""
+        with self._page_cache_lock:
+            entry = self._soup_cache.get(url)
+        if entry is not None and entry[0] == content:
+            return entry[1]
+
+        soup = BeautifulSoup(content, 'lxml')
+        with self._page_cache_lock:
+            self._soup_cache[url] = (content, soup)
+        return soup
+
+    def _rate_limit(self, response=None):
+        """
+        Enforce the minimum interval between live requests.
+
+        Thread-safe: each caller claims the next free slot in the shared
+        schedule and sleeps until it. Cache hits don't consume budget.
+        """
+        if response is not None and getattr(response, 'from_cache', False):
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + self.delay
+        if wait > 0:
+            time.sleep(wait)
     
-    def _rate_limit(self):
-        """Apply rate limiting between requests."""
-        time.sleep(self.delay)
-    
-    def _parse_module_entry(self, element) -> Optional[Dict]:
+    @staticmethod
+    def _iter_module_entries(soup):
+        """
+        Yield page elements that contain a module download link.
+
+        A single streaming CSS-selector pass finds each download anchor,
+        then the anchor's enclosing <li> or <tr> is yielded. This covers
+        both the newer list layout and the older table layout without
+        walking the DOM twice, and iselect lets callers that stop early
+        (e.g. a recent-uploads limit) skip the rest of the page entirely.
+        """
+        seen = set()
+        for anchor in soup.css.iselect('a[href*="downloads.php?moduleid="]'):
+            element = anchor.find_parent(['li', 'tr']) or anchor.parent
+            if element is None or id(element) in seen:
+                continue
+            seen.add(id(element))
+            yield element
+
+    def _extract_modules(self, soup, source_type: str, limit: Optional[int] = None,
+                         seen_ids: Optional[set] = None,
+                         allowed_formats: Optional[FrozenSet[str]] = None) -> List[Dict]:
+        """
+        Parse and deduplicate all module entries on a page.
+
+        Args:
+            soup: Parsed page
+            source_type: Value to stamp on each module's source_type
+            limit: Stop after this many modules (default: no limit)
+            seen_ids: Optional shared ID set for cross-page deduplication
+            allowed_formats: Only keep modules with these formats (default: all)
+
+        Returns:
+            List of module metadata dictionaries in page order
+        """
+        if seen_ids is None:
+            seen_ids = set()
+
+        modules = []
+        for element in self._iter_module_entries(soup):
+            if limit is not None and len(modules) >= limit:
+                break
+
+            module = self._parse_module_entry(element, allowed_formats=allowed_formats)
+            if module and module['id'] not in seen_ids:
+                module['source_type'] = source_type
+                modules.append(module)
+                seen_ids.add(module['id'])
+
+        return modules
+
+    def _parse_module_entry(self, element,
+                            allowed_formats: Optional[FrozenSet[str]] = None) -> Optional[Dict]:
         """
         Parse a module entry from HTML.
 
         This handles both the newer <li> format and older table-based formats.
+        When allowed_formats is given, entries with other formats are rejected
+        before the title/artist lookups, which dominate per-entry cost.
         """
         try:
-            # Find download link with moduleid
-            download_link = element.find('a', href=re.compile(r'downloads\.php\?moduleid=\d+'))
+            # Find download link with moduleid. Plain substring checks here:
+            # BS4 applies the href test to every candidate attribute, and a
+            # lambda doing `in` is much cheaper than a regex match.
+            download_link = element.find(
+                'a', href=lambda h: h and 'downloads.php?moduleid=' in h
+            )
             if not download_link:
                 return None
 
             download_href = download_link['href']
 
-            # Extract module ID from download URL
-            module_id_match = re.search(r'moduleid=(\d+)', download_href)
-            if not module_id_match:
+            # Extract module ID from download URL without the regex engine:
+            # take what follows moduleid= up to the next delimiter
+            module_id_str = (
+                download_href.partition('moduleid=')[2]
+                .split('&', 1)[0]
+                .split('#', 1)[0]
+            )
+            if not module_id_str.isdigit():
                 return None
 
-            module_id = int(module_id_match.group(1))
+            module_id = int(module_id_str)
 
             # Extract filename from the fragment (after #)
             # Example: downloads.php?moduleid=212618#wishes.xm
@@ -66,17 +225,21 @@ class ModArchiveService:
                 filename = f'module_{module_id}.mod'
 
             # Extract format from filename extension
-            format_match = re.search(r'\.([a-z0-9]{2,4})$', filename.lower())
+            format_match = _FMT_RE.search(filename.lower())
             file_format = format_match.group(1) if format_match else None
 
+            # Bail out on unwanted formats before the remaining find() calls
+            if allowed_formats is not None and (file_format or '') not in allowed_formats:
+                return None
+
             # Find the module title link (module.php?XXXXXX)
-            title_link = element.find('a', href=re.compile(r'module\.php\?\d+'))
+            title_link = element.find('a', href=lambda h: h and 'module.php?' in h)
             title = title_link.get_text(strip=True) if title_link else None
 
             # Try to extract artist
             artist = None
             # Look for artist link (member.php?XXXXX)
-            artist_link = element.find('a', href=re.compile(r'member\.php\?\d+'))
+            artist_link = element.find('a', href=lambda h: h and 'member.php?' in h)
             if artist_link:
                 artist = artist_link.get_text(strip=True)
 
@@ -108,31 +271,22 @@ class ModArchiveService:
             List of module metadata dictionaries
         """
         url = f'{self.base_url}/index.php?request=view_actions_uploads'
+        if self._is_known_empty(url):
+            return []
 
         try:
             logger.info(f'Fetching recent uploads from {url}')
             response = self.session.get(url, timeout=self.timeout)
             response.raise_for_status()
 
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Find list items containing module entries
-            modules = []
-            seen_ids = set()
-            list_items = soup.find_all('li')
-
-            for item in list_items:
-                if len(modules) >= limit:
-                    break
-
-                module = self._parse_module_entry(item)
-                if module and module['id'] not in seen_ids:
-                    module['source_type'] = 'recent'
-                    modules.append(module)
-                    seen_ids.add(module['id'])
+            soup = BeautifulSoup(response.content, 'lxml')
+            modules = self._extract_modules(soup, 'recent', limit=limit,
+                                           allowed_formats=self.preferred_formats)
+            if not modules:
+                self._mark_empty(url)
 
             logger.info(f'Found {len(modules)} recent uploads')
-            self._rate_limit()
+            self._rate_limit(response)
             return modules
 
         except Exception as e:
@@ -152,45 +306,31 @@ class ModArchiveService:
         """
         # Pick a random page
         page = random.randint(1, max_page)
+        return self._fetch_top_rated_page(min_rating, page)
+
+    def _fetch_top_rated_page(self, min_rating: int, page: int) -> List[Dict]:
+        """Fetch one page of highly-rated modules, memoized per page."""
+        cached = self._page_cache_get(('rated', min_rating, page))
+        if cached is not None:
+            return cached
+
         url = f'{self.base_url}/index.php?request=view_by_rating_comments&query={min_rating}&page={page}#mods'
+        if self._is_known_empty(url):
+            return []
 
         try:
             logger.info(f'Fetching top-rated modules (>={min_rating}) from page {page}: {url}')
             response = self.session.get(url, timeout=self.timeout)
             response.raise_for_status()
 
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Try both table rows and list items
-            modules = []
-            seen_ids = set()
-
-            # First try list items (newer format)
-            list_items = soup.find_all('li')
-            for item in list_items:
-                module = self._parse_module_entry(item)
-                if module and module['id'] not in seen_ids:
-                    module['source_type'] = 'rated'
-                    modules.append(module)
-                    seen_ids.add(module['id'])
-
-            # If no modules found, try table format (older format)
+            soup = BeautifulSoup(response.content, 'lxml')
+            modules = self._extract_modules(soup, 'rated', allowed_formats=self.preferred_formats)
             if not modules:
-                tables = soup.find_all('table')
-                for table in tables:
-                    rows = table.find_all('tr')
-                    for row in rows:
-                        module = self._parse_module_entry(row)
-                        if module and module['id'] not in seen_ids:
-                            module['source_type'] = 'rated'
-                            modules.append(module)
-                            seen_ids.add(module['id'])
-
-                    if modules:
-                        break
+                self._mark_empty(url)
 
             logger.info(f'Found {len(modules)} top-rated modules on page {page}')
-            self._rate_limit()
+            self._rate_limit(response)
+            self._page_cache_set(('rated', min_rating, page), modules)
             return modules
 
         except Exception as e:
@@ -208,6 +348,7 @@ class ModArchiveService:
         modules = []
         seen_ids = set()
         page = 1
+        response = None
 
         try:
             logger.info(f'Fetching featured modules from {url}')
@@ -216,52 +357,31 @@ class ModArchiveService:
             # Start with page 1 and continue if needed
             while True:
                 page_url = f'{url}&page={page}' if page > 1 else url
+                if self._is_known_empty(page_url):
+                    break
                 response = self.session.get(page_url, timeout=self.timeout)
                 response.raise_for_status()
 
-                soup = BeautifulSoup(response.content, 'html.parser')
-
-                # Try both table rows and list items
-                page_modules = []
-
-                # First try list items (newer format)
-                list_items = soup.find_all('li')
-                for item in list_items:
-                    module = self._parse_module_entry(item)
-                    if module and module['id'] not in seen_ids:
-                        module['source_type'] = 'featured'
-                        page_modules.append(module)
-                        seen_ids.add(module['id'])
-
-                # If no modules found, try table format (older format)
+                soup = self._soup_for(page_url, response.content)
+                page_modules = self._extract_modules(soup, 'featured', seen_ids=seen_ids,
+                                                     allowed_formats=self.preferred_formats)
                 if not page_modules:
-                    tables = soup.find_all('table')
-                    for table in tables:
-                        rows = table.find_all('tr')
-                        for row in rows:
-                            module = self._parse_module_entry(row)
-                            if module and module['id'] not in seen_ids:
-                                module['source_type'] = 'featured'
-                                page_modules.append(module)
-                                seen_ids.add(module['id'])
-
-                        if page_modules:
-                            break
-
+                    self._mark_empty(page_url)
                 modules.extend(page_modules)
 
                 # If we found modules on this page, return them
                 # The curator will filter for unlistened ones
                 if page_modules:
                     logger.info(f'Found {len(modules)} featured modules')
-                    self._rate_limit()
+                    self._rate_limit(response)
                     return modules
 
                 # No more modules found, stop searching
                 break
 
             logger.info(f'Found {len(modules)} featured modules')
-            self._rate_limit()
+            if response is not None:
+                self._rate_limit(response)
             return modules
 
         except Exception as e:
@@ -280,54 +400,58 @@ class ModArchiveService:
         """
         # Pick a random page
         page = random.randint(1, max_page)
+        return self._fetch_top_favourites_page(page)
+
+    def _fetch_top_favourites_page(self, page: int) -> List[Dict]:
+        """Fetch one page of top favourites, memoized per page."""
+        cached = self._page_cache_get(('favourites', page))
+        if cached is not None:
+            return cached
+
         url = f'{self.base_url}/index.php?request=view_top_favourites&page={page}#mods'
+        if self._is_known_empty(url):
+            return []
 
         try:
             logger.info(f'Fetching top favourites from page {page}: {url}')
             response = self.session.get(url, timeout=self.timeout)
             response.raise_for_status()
 
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Try both table rows and list items
-            modules = []
-            seen_ids = set()
-
-            # First try list items (newer format)
-            list_items = soup.find_all('li')
-            for item in list_items:
-                module = self._parse_module_entry(item)
-                if module and module['id'] not in seen_ids:
-                    module['source_type'] = 'favourites'
-                    modules.append(module)
-                    seen_ids.add(module['id'])
-
-            # If no modules found, try table format (older format)
+            soup = BeautifulSoup(response.content, 'lxml')
+            modules = self._extract_modules(soup, 'favourites', allowed_formats=self.preferred_formats)
             if not modules:
-                tables = soup.find_all('table')
-                for table in tables:
-                    rows = table.find_all('tr')
-                    for row in rows:
-                        module = self._parse_module_entry(row)
-                        if module and module['id'] not in seen_ids:
-                            module['source_type'] = 'favourites'
-                            modules.append(module)
-                            seen_ids.add(module['id'])
-
-                    if modules:
-                        break
+                self._mark_empty(url)
 
             logger.info(f'Found {len(modules)} top favourites on page {page}')
-            self._rate_limit()
+            self._rate_limit(response)
+            self._page_cache_set(('favourites', page), modules)
             return modules
 
         except Exception as e:
             logger.error(f'Error fetching top favourites: {e}')
             return []
 
+    def _fetch_one_random(self) -> Optional[Dict]:
+        """Fetch a single module from the random page."""
+        url = f'{self.base_url}/index.php?request=view_random'
+
+        try:
+            self._rate_limit()
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+
+            soup = BeautifulSoup(response.content, 'lxml')
+            modules = self._extract_modules(soup, 'random', limit=1,
+                                           allowed_formats=self.preferred_formats)
+            return modules[0] if modules else None
+
+        except Exception as e:
+            logger.error(f'Error fetching random module: {e}')
+            return None
+
     def fetch_random_modules(self, count: int = 5) -> List[Dict]:
         """
-        Fetch random modules.
+        Fetch random modules, one page per module, concurrently.
 
         Args:
             count: Number of random modules to fetch
@@ -335,54 +459,22 @@ class ModArchiveService:
         Returns:
             List of module metadata dictionaries
         """
-        url = f'{self.base_url}/index.php?request=view_random'
-        modules = []
-        seen_ids = set()
+        logger.info(f'Fetching {count} random modules')
 
-        try:
-            logger.info(f'Fetching {count} random modules')
+        # view_random serves one module per request; run the requests on
+        # a few workers over the pooled connection instead of serially
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: self._fetch_one_random(), range(count)))
 
-            # Fetch multiple random modules (one per request)
-            for i in range(count):
-                response = self.session.get(url, timeout=self.timeout)
-                response.raise_for_status()
-
-                soup = BeautifulSoup(response.content, 'html.parser')
-
-                # Try list items first (newer format)
-                list_items = soup.find_all('li')
-                for item in list_items:
-                    module = self._parse_module_entry(item)
-                    if module and module['id'] not in seen_ids:
-                        module['source_type'] = 'random'
-                        modules.append(module)
-                        seen_ids.add(module['id'])
-                        break
-
-                # If no module found, try table format (older format)
-                if len(modules) <= i:
-                    tables = soup.find_all('table')
-                    for table in tables:
-                        rows = table.find_all('tr')
-                        for row in rows:
-                            module = self._parse_module_entry(row)
-                            if module and module['id'] not in seen_ids:
-                                module['source_type'] = 'random'
-                                modules.append(module)
-                                seen_ids.add(module['id'])
-                                break
-                        if modules and len(modules) > i:
-                            break
-
-                if i < count - 1:
-                    self._rate_limit()
-
-            logger.info(f'Found {len(modules)} random modules')
-            return modules
+        modules = []
+        seen_ids = set()
+        for module in results:
+            if module and module['id'] not in seen_ids:
+                modules.append(module)
+                seen_ids.add(module['id'])
 
-        except Exception as e:
-            logger.error(f'Error fetching random modules: {e}')
-            return modules  # Return what we got so far
+        logger.info(f'Found {len(modules)} random modules')
+        return modules
     
     def get_download_url(self, module_id: int) -> str:
         """
@@ -396,24 +488,21 @@ class ModArchiveService:
         """
         return f'{self.api_url}/downloads.php?moduleid={module_id}'
     
-    def filter_by_format(self, modules: List[Dict], preferred_formats: List[str]) -> List[Dict]:
+    def filter_by_format(self, modules: List[Dict], preferred_formats: FrozenSet[str]) -> List[Dict]:
         """
         Filter modules by preferred formats.
 
         Args:
             modules: List of module dictionaries
-            preferred_formats: List of preferred format extensions (e.g., ['mod', 'xm'])
+            preferred_formats: Preferred format extensions, lowercased (e.g., {'mod', 'xm'})
 
         Returns:
             Filtered list of modules
         """
-        filtered = []
-
-        for module in modules:
-            module_format = module.get('format')
-            if module_format:
-                if module_format.lower() in [fmt.lower() for fmt in preferred_formats]:
-                    filtered.append(module)
+        filtered = [
+            module for module in modules
+            if (module.get('format') or '').lower() in preferred_formats
+        ]
 
         logger.info(f'Filtered {len(modules)} modules to {len(filtered)} with preferred formats')
         return filtered
@@ -3,12 +3,22 @@ Player Service
 
 Manages module file downloads and caching.
 """
+import atexit
+import functools
+import json
 import logging
-from datetime import datetime, timedelta
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional
 
 import requests
+from cachetools import LRUCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from config import Config
 from models import Module
@@ -18,63 +28,370 @@ logger = logging.getLogger(__name__)
 
 class PlayerService:
     """Service for managing module files."""
-    
+
+    # Config.CACHE_DIR is process-global, so one successful mkdir covers
+    # every instance (test harnesses and reloads construct several)
+    _cache_dir_ready = False
+
+    # Background pool for stale-while-revalidate refreshes; class-level so
+    # it is shared and never grows with instance churn
+    _refresh_executor = ThreadPoolExecutor(max_workers=2,
+                                           thread_name_prefix='modcache-refresh')
+
     def __init__(self):
         self.cache_dir = Config.CACHE_DIR
-        self.cache_max_age = timedelta(days=Config.CACHE_MAX_AGE_DAYS)
+        self.cache_max_age_seconds = Config.CACHE_MAX_AGE_DAYS * 86400
         self.timeout = Config.REQUEST_TIMEOUT
-        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if not PlayerService._cache_dir_ready:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            PlayerService._cache_dir_ready = True
+        # One session for all downloads: keep-alive connections skip the
+        # per-request TCP/TLS handshake, and transient errors are retried
+        # with backoff at the adapter level
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=64,
+            pool_block=False,
+            max_retries=Retry(
+                total=3,
+                connect=3,
+                read=3,
+                backoff_factor=0.2,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET']),
+            ),
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'User-Agent': 'ModPlayer/1.0 (Personal mod music player)'
+        })
+        # Recently served payloads, bounded by total bytes rather than
+        # entry count. Keys carry the file's mtime so a refreshed file
+        # misses naturally and the stale entry ages out of the LRU.
+        self._bytes_cache = LRUCache(maxsize=32 * 1024 * 1024, getsizeof=len)
+        self._bytes_lock = threading.Lock()
+        # Module IDs with a background refresh in flight
+        self._refreshing: set = set()
+        self._refresh_lock = threading.Lock()
+        # Shard directories known to exist; mkdir is idempotent so the
+        # unguarded set is just a fast path
+        self._ready_shards: set = set()
+        # Single-flight locks per module ID so concurrent callers share
+        # one download; LRU-bounded since stale locks are harmless
+        self._inflight_locks = LRUCache(maxsize=1024)
+        self._map_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def close(self):
+        """Release the session's pooled connections."""
+        self.session.close()
     
     def get_module_file(self, module: Module) -> Optional[bytes]:
         """
         Download and cache module file.
-        
+
         Args:
             module: Module object
-            
+
         Returns:
             File contents as bytes, or None if download failed
         """
-        cache_path = self._get_cache_path(module.id)
-        
-        # Check if file exists in cache and is recent
-        if cache_path.exists():
-            file_age = datetime.now() - datetime.fromtimestamp(cache_path.stat().st_mtime)
-            if file_age < self.cache_max_age:
-                logger.info(f'Loading module {module.id} from cache')
+        cache_path = self.get_module_path(module)
+        if cache_path is None:
+            return None
+
+        try:
+            key = (module.id, cache_path.stat().st_mtime_ns)
+            with self._bytes_lock:
+                data = self._bytes_cache.get(key)
+            if data is not None:
+                return data
+
+            data = cache_path.read_bytes()
+            with self._bytes_lock:
                 try:
-                    return cache_path.read_bytes()
-                except Exception as e:
-                    logger.warning(f'Error reading cached file: {e}')
-        
-        # Download from Mod Archive
-        logger.info(f'Downloading module {module.id} from {module.download_url}')
+                    self._bytes_cache[key] = data
+                except ValueError:
+                    pass  # Payload larger than the whole cache budget
+            return data
+        except Exception as e:
+            logger.error(f'Error reading cached file for module {module.id}: {e}')
+            return None
+
+    def get_module_files(self, modules: List[Module],
+                         max_workers: int = 8) -> Dict[int, Optional[bytes]]:
+        """
+        Download several module files concurrently.
+
+        The shared session is safe for concurrent requests and its adapter
+        pool covers the worker fan-out, so bulk fetches overlap their
+        network latency. Callers should pass fully loaded Module rows;
+        the workers only read already-loaded attributes.
+
+        Args:
+            modules: Module objects to fetch
+
+        Returns:
+            Mapping of module ID to file bytes (None where a fetch failed)
+        """
+        if not modules:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(self.get_module_file, modules))
+
+        return {module.id: data for module, data in zip(modules, results)}
+
+    def get_module_path(self, module: Module) -> Optional[Path]:
+        """
+        Ensure a module file is cached locally and return its path.
+
+        Lets callers stream the file straight from disk (e.g. via
+        send_file) instead of holding the whole payload in memory.
+
+        Args:
+            module: Module object
+
+        Returns:
+            Path to the cached file, or None if it could not be fetched
+        """
+        cache_path = self._get_cache_path(module.id)
+
+        # One stat covers both the existence and freshness checks; raw
+        # float mtime math avoids datetime allocations on every request
+        try:
+            st = os.stat(cache_path)
+        except FileNotFoundError:
+            st = self._adopt_legacy_entry(module.id, cache_path)
+
+        if st is not None:
+            if time.time() - st.st_mtime < self.cache_max_age_seconds:
+                logger.info(f'Module {module.id} found in cache')
+            else:
+                # Stale-while-revalidate: serve the old copy now and
+                # refresh off the critical path — modules rarely change
+                self._schedule_refresh(module.id, module.download_url)
+            return cache_path
+
+        return self._download(module.id, module.download_url, have_cached=False)
+
+    def _schedule_refresh(self, module_id: int, download_url: str):
+        """Queue a background re-download unless one is already running."""
+        with self._refresh_lock:
+            if module_id in self._refreshing:
+                return
+            self._refreshing.add(module_id)
+        self._refresh_executor.submit(self._refresh, module_id, download_url)
+
+    def _refresh(self, module_id: int, download_url: str):
+        """Background worker: re-download one module, then clear the flag."""
+        try:
+            path = self._download(module_id, download_url, have_cached=True)
+            if path is not None:
+                self._drop_page_cache(path)
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(module_id)
+
+    @staticmethod
+    def _drop_page_cache(path: Path):
+        """
+        Advise the kernel that a freshly refreshed file's pages can go.
+
+        Background refreshes stream whole files through the page cache
+        without anyone reading them; dropping those pages protects the
+        working set of modules actually being played. No-op on platforms
+        without posix_fadvise.
+        """
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def _inflight_lock(self, module_id: int) -> threading.Lock:
+        """Get the single-flight download lock for a module."""
+        with self._map_lock:
+            lock = self._inflight_locks.get(module_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._inflight_locks[module_id] = lock
+            return lock
+
+    def _download(self, module_id: int, download_url: str,
+                  have_cached: bool) -> Optional[Path]:
+        """
+        Fetch a module into the cache and return its path.
+
+        Concurrent callers for the same module share one fetch via a
+        per-ID lock. Takes plain values rather than a Module row so
+        background refresh workers never touch the ORM session.
+        """
+        cache_path = self._get_cache_path(module_id)
+
+        with self._inflight_lock(module_id):
+            # Double-check after acquiring the lock: a caller we waited on
+            # may have finished this very download
+            try:
+                if time.time() - os.stat(cache_path).st_mtime < self.cache_max_age_seconds:
+                    return cache_path
+            except FileNotFoundError:
+                pass
+
+            return self._download_locked(module_id, download_url, cache_path,
+                                         have_cached)
+
+    def _download_locked(self, module_id: int, download_url: str,
+                         cache_path: Path, have_cached: bool) -> Optional[Path]:
+        """Perform the actual fetch; caller holds the per-module lock."""
+        # Revalidate an expired copy with its stored validators so an
+        # unchanged module costs a bodyless 304 instead of a re-download
+        headers = {}
+        if have_cached:
+            meta = self._load_meta(module_id)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        # Download from Mod Archive, streaming straight to disk so the
+        # payload is never fully buffered in memory; the rename makes the
+        # cached file appear atomically
+        logger.info(f'Downloading module {module_id} from {download_url}')
+        part_path = None
         try:
-            response = requests.get(module.download_url, timeout=self.timeout)
-            response.raise_for_status()
-            
-            # Save to cache
-            cache_path.write_bytes(response.content)
-            logger.info(f'Cached module {module.id} to {cache_path}')
-            
-            return response.content
-            
+            with self.session.get(download_url, timeout=self.timeout,
+                                  stream=True, headers=headers or None) as response:
+                if response.status_code == 304:
+                    # Unchanged upstream: bump mtime to restart the TTL
+                    os.utime(cache_path, None)
+                    logger.info(f'Module {module_id} unchanged upstream (304)')
+                    return cache_path
+
+                response.raise_for_status()
+                self._ensure_shard(cache_path.parent)
+                # A uniquely named temp file in the shard dir keeps the
+                # final rename atomic and lets concurrent downloads of the
+                # same module race safely (last replace wins, both valid)
+                with tempfile.NamedTemporaryFile(dir=cache_path.parent,
+                                                 suffix='.part',
+                                                 delete=False) as cache_file:
+                    part_path = Path(cache_file.name)
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        cache_file.write(chunk)
+                    cache_file.flush()
+                    os.fsync(cache_file.fileno())
+                self._save_meta(module_id, response.headers)
+
+            os.replace(part_path, cache_path)
+            logger.info(f'Cached module {module_id} to {cache_path}')
+
+            return cache_path
+
         except Exception as e:
-            logger.error(f'Error downloading module {module.id}: {e}')
-            
+            logger.error(f'Error downloading module {module_id}: {e}')
+            if part_path is not None:
+                part_path.unlink(missing_ok=True)
+
             # If download fails but we have a cached (even old) version, use it
-            if cache_path.exists():
-                logger.info(f'Using old cached version for module {module.id}')
-                try:
-                    return cache_path.read_bytes()
-                except Exception as e2:
-                    logger.error(f'Error reading old cached file: {e2}')
-            
+            if have_cached:
+                logger.info(f'Using old cached version for module {module_id}')
+                return cache_path
+
             return None
     
+    @functools.lru_cache(maxsize=4096)
     def _get_cache_path(self, module_id: int) -> Path:
-        """Get the cache file path for a module."""
-        return self.cache_dir / f'{module_id}.mod'
+        """Get the cache file path for a module.
+
+        Files are sharded into 256 subdirectories by module ID so no
+        single directory grows unboundedly. Memoized: the path is a pure
+        function of the ID and the fixed cache dir, and it's rebuilt on
+        every lookup and refresh.
+        """
+        return self.cache_dir / f'{module_id % 256:02x}' / f'{module_id}.mod'
+
+    def _meta_path(self, module_id: int) -> Path:
+        """Get the validator sidecar path for a module."""
+        return self.cache_dir / f'{module_id % 256:02x}' / f'{module_id}.meta.json'
+
+    def _ensure_shard(self, shard_dir: Path):
+        """Create a shard directory on first write."""
+        if shard_dir not in self._ready_shards:
+            shard_dir.mkdir(parents=True, exist_ok=True)
+            self._ready_shards.add(shard_dir)
+
+    def _adopt_legacy_entry(self, module_id: int, cache_path: Path):
+        """
+        Move a pre-sharding flat cache file into its shard, if present.
+
+        Returns the file's stat result when a legacy entry was adopted,
+        None otherwise.
+        """
+        legacy = self.cache_dir / f'{module_id}.mod'
+        try:
+            st = os.stat(legacy)
+        except FileNotFoundError:
+            return None
+
+        try:
+            self._ensure_shard(cache_path.parent)
+            os.replace(legacy, cache_path)
+            legacy_meta = self.cache_dir / f'{module_id}.meta.json'
+            if legacy_meta.exists():
+                os.replace(legacy_meta, self._meta_path(module_id))
+            return st
+        except OSError as e:
+            logger.warning(f'Error migrating cached module {module_id}: {e}')
+            return None
+
+    def _iter_cache_files(self):
+        """
+        Yield a DirEntry for every cached .mod file.
+
+        Walks the shard subdirectories and also picks up flat files from
+        the pre-sharding layout.
+        """
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    with os.scandir(entry.path) as shard_entries:
+                        for shard_entry in shard_entries:
+                            if (shard_entry.name.endswith('.mod')
+                                    and shard_entry.is_file(follow_symlinks=False)):
+                                yield shard_entry
+                elif entry.name.endswith('.mod') and entry.is_file(follow_symlinks=False):
+                    yield entry
+
+    def _load_meta(self, module_id: int) -> dict:
+        """Load the stored HTTP validators for a cached module."""
+        try:
+            return json.loads(self._meta_path(module_id).read_text())
+        except Exception:
+            return {}
+
+    def _save_meta(self, module_id: int, headers):
+        """Persist response validators for future conditional requests."""
+        meta = {}
+        if headers.get('ETag'):
+            meta['etag'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            meta['last_modified'] = headers['Last-Modified']
+
+        try:
+            if meta:
+                self._meta_path(module_id).write_text(json.dumps(meta))
+            else:
+                self._meta_path(module_id).unlink(missing_ok=True)
+        except Exception as e:
+            logger.warning(f'Error writing cache metadata for module {module_id}: {e}')
     
     def clear_old_cache(self, max_age_days: Optional[int] = None):
         """
@@ -86,28 +403,36 @@ class PlayerService:
         if max_age_days is None:
             max_age_days = Config.CACHE_MAX_AGE_DAYS
         
-        cutoff = datetime.now() - timedelta(days=max_age_days)
-        
+        cutoff = time.time() - max_age_days * 86400
+
+        # scandir reuses the stat data from the directory listing, so the
+        # sweep costs one batched syscall instead of one stat per file
         deleted_count = 0
-        for cache_file in self.cache_dir.glob('*.mod'):
+        for entry in self._iter_cache_files():
             try:
-                file_mtime = datetime.fromtimestamp(cache_file.stat().st_mtime)
-                if file_mtime < cutoff:
-                    cache_file.unlink()
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    try:
+                        os.unlink(entry.path[:-4] + '.meta.json')
+                    except FileNotFoundError:
+                        pass
                     deleted_count += 1
-            except Exception as e:
-                logger.warning(f'Error deleting cache file {cache_file}: {e}')
-        
+            except OSError as e:
+                logger.warning(f'Error deleting cache file {entry.path}: {e}')
+
         logger.info(f'Cleared {deleted_count} old cached modules')
         return deleted_count
-    
+
     def get_cache_stats(self) -> dict:
         """Get statistics about the cache."""
-        cache_files = list(self.cache_dir.glob('*.mod'))
-        total_size = sum(f.stat().st_size for f in cache_files)
-        
+        count = 0
+        total_size = 0
+        for entry in self._iter_cache_files():
+            count += 1
+            total_size += entry.stat().st_size
+
         return {
-            'count': len(cache_files),
+            'count': count,
             'total_size_bytes': total_size,
             'total_size_mb': round(total_size / (1024 * 1024), 2),
         }